@@ -0,0 +1,242 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap
+
+NODE = 0
+LEAF = 1
+HEADER = 5
+
+
+class ByteTreeError(Exception):
+    pass
+
+
+def node_header(children):
+    return bytes([NODE]) + children.to_bytes(4, 'big')
+
+
+def leaf_header(length):
+    return bytes([LEAF]) + length.to_bytes(4, 'big')
+
+
+def leaf(data):
+    return leaf_header(len(data)) + data
+
+
+def node(*children):
+    r"""
+    Encode a node of already encoded children.
+
+    >>> node(leaf(b"\x07"), leaf(b"\xff")).hex()
+    '00000000020100000001070100000001ff'
+    """
+    return node_header(len(children)) + b"".join(children)
+
+
+class ByteTree(object):
+    """
+    Lazily decoded Verificatum byte tree located at offset in buffer.
+
+    Every tree starts with a 5 byte header: one type byte (0 for node, 1 for
+    leaf) followed by a 4 byte big-endian length, which is the number of
+    children for a node and the number of data bytes for a leaf. Nothing
+    below the header is read until it is asked for.
+
+    >>> t = ByteTree(bytes.fromhex("00000000020100000001070100000001ff"))
+    >>> t.is_leaf, t.length, t.end
+    (False, 2, 17)
+    >>> [c.to_int() for c in t.children()]
+    [7, 255]
+    """
+
+    def __init__(self, buf, offset=0):
+        if offset + HEADER > len(buf):
+            raise ByteTreeError("truncated header at offset %d" % offset)
+        self.buf = buf
+        self.offset = offset
+        self.is_leaf = buf[offset] == LEAF
+        if not self.is_leaf and buf[offset] != NODE:
+            raise ByteTreeError("invalid type byte %d at offset %d" %
+                                (buf[offset], offset))
+        self.length = int.from_bytes(buf[offset+1:offset+HEADER], 'big')
+        self.start = offset + HEADER
+        self._end = None
+        self._leaflen = None
+
+    @property
+    def end(self):
+        """
+        Offset of the first byte following this tree.
+        """
+        if self._end is None:
+            if self.is_leaf:
+                self._end = self.start + self.length
+            elif self.leaf_array() is not None:
+                self._end = self.start + self.length * (HEADER + self._leaflen)
+            else:
+                pos = self.start
+                for _ in range(self.length):
+                    pos = ByteTree(self.buf, pos).end
+                self._end = pos
+            if self._end > len(self.buf):
+                raise ByteTreeError("truncated tree at offset %d" %
+                                    self.offset)
+        return self._end
+
+    @property
+    def size(self):
+        return self.end - self.offset
+
+    def leaf_array(self):
+        """
+        Return the common data length if this is a node whose children are
+        all leaves of equal length (an array of group or field elements),
+        otherwise None. The children headers are compared column-wise with
+        strided slices, so arrays of millions of elements are checked
+        without decoding each child separately.
+        """
+        if self._leaflen is not None:
+            return self._leaflen
+        if self.is_leaf or self.length == 0:
+            return None
+        buf = self.buf
+        start = self.start
+        if start + HEADER > len(buf) or buf[start] != LEAF:
+            return None
+        header = bytes(buf[start:start+HEADER])
+        leaflen = int.from_bytes(header[1:], 'big')
+        stride = HEADER + leaflen
+        end = start + self.length * stride
+        if end > len(buf):
+            return None
+        for k in range(HEADER):
+            if buf[start+k:end:stride] != header[k:k+1] * self.length:
+                return None
+        self._leaflen = leaflen
+        return leaflen
+
+    def children(self):
+        if self.is_leaf:
+            raise ByteTreeError("leaf at offset %d has no children" %
+                                self.offset)
+        pos = self.start
+        for _ in range(self.length):
+            child = ByteTree(self.buf, pos)
+            yield child
+            pos = child.end
+
+    def child(self, index):
+        if self.is_leaf or not 0 <= index < self.length:
+            raise ByteTreeError("no child %d at offset %d" %
+                                (index, self.offset))
+        leaflen = self.leaf_array()
+        if leaflen is not None:
+            return ByteTree(self.buf, self.start + index * (HEADER + leaflen))
+        for i, c in enumerate(self.children()):
+            if i == index:
+                return c
+
+    def data(self):
+        if not self.is_leaf:
+            raise ByteTreeError("node at offset %d has no data" %
+                                self.offset)
+        if self.end > len(self.buf):
+            raise ByteTreeError("truncated leaf at offset %d" % self.offset)
+        return bytes(self.buf[self.start:self.end])
+
+    def to_int(self):
+        return int.from_bytes(self.data(), 'big')
+
+    def raw(self):
+        return bytes(self.buf[self.offset:self.end])
+
+
+def shape(tree):
+    """
+    Describe an array of (possibly product) group elements.
+
+    Verificatum stores an array of product group elements column-wise: a node
+    with one child per factor, down to plain arrays of leaves. Returns a
+    tuple (arities, count, leaflen), where arities lists the node widths
+    above the leaf arrays, or None if the tree is not such an array.
+
+    >>> col = "00000000030100000001010100000001020100000001ff"
+    >>> shape(ByteTree(bytes.fromhex("0000000002" + col + col)))
+    ((2,), 3, 1)
+    """
+    if tree.is_leaf:
+        return None
+    if tree.length == 0:
+        return ((), 0, None)
+    leaflen = tree.leaf_array()
+    if leaflen is not None:
+        return ((), tree.length, leaflen)
+    sub = None
+    for c in tree.children():
+        s = shape(c)
+        if s is None or (sub is not None and s != sub):
+            return None
+        sub = s
+    if sub is None:
+        return None
+    return ((tree.length,) + sub[0], sub[1], sub[2])
+
+
+def columns(tree):
+    """
+    Return the leaf arrays of an array of product group elements in
+    depth-first order, i.e. one array per factor of the product group.
+    """
+    if tree.leaf_array() is not None or tree.length == 0:
+        return [tree]
+    cols = []
+    for c in tree.children():
+        cols.extend(columns(c))
+    return cols
+
+
+class BytetreeFile(object):
+    """
+    Memory-mapped byte tree file. Use as a context manager, the root tree is
+    available as the root attribute.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            self.f.close()
+            raise ByteTreeError("empty file %s" % path)
+        try:
+            self.root = ByteTree(self.mm)
+        except ByteTreeError:
+            self.close()
+            raise
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
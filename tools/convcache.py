@@ -0,0 +1,303 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+
+import asn1
+import bytetree
+
+KEYLEN = 32
+
+log = logging.getLogger("runner")
+
+
+class CacheError(Exception):
+    pass
+
+
+def fingerprint(params, width, keywidth):
+    h = hashlib.sha256()
+    for v in list(params) + [width, keywidth]:
+        h.update("{}\n".format(v).encode('ascii'))
+    return h.hexdigest()[:32]
+
+
+def ballot_key(labels, ct):
+    """
+    Cache key of a ballot: hash of its label tuple (election, district,
+    station, question) and ciphertext.
+    """
+    h = hashlib.sha256()
+    for label in labels:
+        b = label.encode('utf-8')
+        h.update(len(b).to_bytes(4, 'big'))
+        h.update(b)
+    h.update(ct)
+    return h.digest()
+
+
+def ciphertext_elements(ct):
+    """
+    Return the blind and blinded message of a DER encoded IVXV ElGamal
+    ciphertext. The ciphertext is a sequence of the algorithm identifier and
+    a sequence of these two integers, so the last sequence of two integers is
+    taken.
+    """
+    found = None
+    stack = list(reversed(asn1.parse_der(ct)))
+    while stack:
+        field = stack.pop()
+        if field.constr != 'constructed':
+            continue
+        if (len(field.value) == 2 and
+                all(f.tag == 'INTEGER' for f in field.value)):
+            found = field.value
+        stack.extend(reversed(field.value))
+    if found is None:
+        raise CacheError("ciphertext is not an ElGamal ciphertext")
+    return tuple(int.from_bytes(f.value, 'big') for f in found)
+
+
+def check_conversion(path, cts):
+    """
+    Check that the converted ciphertexts in byte tree file path are the
+    ballots cts in the same order. The last factor of both halves of a
+    converted ciphertext is the blind and the blinded message of the ballot,
+    the other factors encode its labels.
+    """
+    with bytetree.BytetreeFile(path) as bt:
+        s = bytetree.shape(bt.root)
+        if s is None or s[1] != len(cts) or not s[0] or s[0][0] != 2:
+            raise CacheError("unexpected conversion output {}".format(s))
+        cols = bytetree.columns(bt.root)
+        starts = [cols[len(cols) // 2 - 1].start, cols[-1].start]
+        elemlen = bytetree.HEADER + s[2]
+        for i, ct in enumerate(cts):
+            got = tuple(int.from_bytes(
+                bt.mm[start + i * elemlen + bytetree.HEADER:
+                      start + (i + 1) * elemlen], 'big') for start in starts)
+            if got != ciphertext_elements(ct):
+                raise CacheError("converted ciphertext {} does not match "
+                                 "its ballot, not caching".format(i))
+
+
+def ballots(abb):
+    """
+    Iterate over (labels, ciphertext) of an IVXV anonymous ballot box in the
+    order the adapter reads them.
+    """
+    election = abb["election"]
+    for district, stations in abb["districts"].items():
+        for station, questions in stations.items():
+            for question, cts in questions.items():
+                for ct in cts:
+                    yield ((election, district, station, question),
+                           base64.b64decode(ct))
+
+
+class Store(object):
+    """
+    Append-only store of converted ciphertexts.
+
+    The store starts with a JSON header line holding the arities of the
+    ciphertext group and the leaf length of its elements. It is followed by
+    fixed size records: the ballot key and the byte tree leaves of every
+    factor of the converted ciphertext, in depth-first order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.arities = None
+        self.leaflen = None
+        self.index = {}
+        self.mm = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            try:
+                header = json.loads(f.readline().decode('ascii'))
+                self._set_layout(tuple(header["arities"]),
+                                 int(header["leaflen"]))
+            except (ValueError, KeyError, TypeError):
+                raise CacheError("invalid header in {}".format(self.path))
+            self.base = f.tell()
+        size = os.path.getsize(self.path)
+        count = (size - self.base) // self.reclen
+        if self.base + count * self.reclen != size:
+            # interrupted append, drop the partial record
+            log.warning("Truncating partial record in %s", self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(self.base + count * self.reclen)
+        if count == 0:
+            return
+        with open(self.path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for i in range(count):
+            off = self.base + i * self.reclen
+            self.index[self.mm[off:off+KEYLEN]] = off + KEYLEN
+
+    def _set_layout(self, arities, leaflen):
+        self.arities = arities
+        self.leaflen = leaflen
+        self.ncols = 1
+        for a in arities:
+            self.ncols *= a
+        self.elemlen = bytetree.HEADER + leaflen
+        self.reclen = KEYLEN + self.ncols * self.elemlen
+
+    def append(self, keys, path):
+        """
+        Add the ciphertexts converted to byte tree file path, which are in
+        the order of keys.
+        """
+        with bytetree.BytetreeFile(path) as bt:
+            s = bytetree.shape(bt.root)
+            if s is None or s[1] != len(keys):
+                raise CacheError("unexpected conversion output {}".format(s))
+            if self.arities is None:
+                self._set_layout(s[0], s[2])
+                with open(self.path, "wb") as f:
+                    f.write(json.dumps({"arities": s[0],
+                                        "leaflen": s[2]}).encode('ascii'))
+                    f.write(b"\n")
+            elif (self.arities, self.leaflen) != (s[0], s[2]):
+                raise CacheError("conversion output {} does not match "
+                                 "cache layout".format(s))
+            starts = [c.start for c in bytetree.columns(bt.root)]
+            with open(self.path, "ab") as f:
+                for i, key in enumerate(keys):
+                    f.write(key)
+                    for start in starts:
+                        off = start + i * self.elemlen
+                        f.write(bt.mm[off:off+self.elemlen])
+        self.close()
+        self.index = {}
+        self._load()
+
+    def write(self, keys, path):
+        """
+        Write the byte tree of the cached ciphertexts of keys to path.
+        """
+        offsets = [self.index[k] for k in keys]
+        col = [0]
+
+        def write_tree(f, arities):
+            if arities:
+                f.write(bytetree.node_header(arities[0]))
+                for _ in range(arities[0]):
+                    write_tree(f, arities[1:])
+                return
+            f.write(bytetree.node_header(len(offsets)))
+            skip = col[0] * self.elemlen
+            for off in offsets:
+                off += skip
+                f.write(self.mm[off:off+self.elemlen])
+            col[0] += 1
+
+        with open(path, "wb") as f:
+            write_tree(f, self.arities)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+def convert(cachedir, params, width, keywidth, bbox, out, convert_fn):
+    """
+    Convert the ballot box bbox to Verificatum ciphertexts in out, running
+    convert_fn(ballotbox, ciphertexts) only on the ballots which are not yet
+    in the cache under cachedir. Returns the number of ballots converted.
+    """
+    with open(bbox) as f:
+        abb = json.load(f)
+    keys = []
+    missing = {}
+    for labels, ct in ballots(abb):
+        key = ballot_key(labels, ct)
+        keys.append(key)
+        missing[key] = labels
+    if not keys:
+        convert_fn(bbox, out)
+        return 0
+    os.makedirs(cachedir, exist_ok=True)
+    path = os.path.join(cachedir,
+                        fingerprint(params, width, keywidth) + ".store")
+    try:
+        store = Store(path)
+    except CacheError as e:
+        # e.g. an append interrupted before the header was written
+        log.warning("%s, starting a new conversion cache", e)
+        os.remove(path)
+        store = Store(path)
+    try:
+        for key in store.index:
+            missing.pop(key, None)
+        log.info("%d of %d ballots found in conversion cache",
+                 len(keys) - len(missing), len(keys))
+        converted = 0
+        if missing:
+            try:
+                converted = _convert_missing(store, abb, missing, convert_fn)
+            except CacheError as e:
+                log.warning("%s, converting the whole ballot box", e)
+                convert_fn(bbox, out)
+                return len(keys)
+        store.write(keys, out)
+    finally:
+        store.close()
+    return converted
+
+
+def _convert_missing(store, abb, missing, convert_fn):
+    districts = {}
+    newkeys = []
+    newcts = []
+    for labels, ct in ballots(abb):
+        key = ballot_key(labels, ct)
+        if key not in missing:
+            continue
+        # convert every new ballot once, even if repeated in the box
+        del missing[key]
+        newkeys.append(key)
+        newcts.append(ct)
+        _, district, station, question = labels
+        districts.setdefault(district, {}).setdefault(station, {}) \
+            .setdefault(question, []).append(base64.b64encode(ct).decode())
+    partial = dict(abb)
+    partial["districts"] = districts
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(store.path))
+    try:
+        bbox = os.path.join(tmpdir, "ballotbox.json")
+        with open(bbox, "w") as f:
+            json.dump(partial, f)
+        out = os.path.join(tmpdir, "ciphertexts")
+        convert_fn(bbox, out)
+        check_conversion(out, newcts)
+        store.append(newkeys, out)
+    finally:
+        shutil.rmtree(tmpdir)
+    return len(newkeys)
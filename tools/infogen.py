@@ -0,0 +1,357 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import xml.etree.ElementTree as ET
+
+import bytetree
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+VERSION = "3.0.4"
+PKG = "com.verificatum."
+
+# com.verificatum.arithm.ModPGroup encodings
+RO_ENCODING = 0
+SAFEPRIME_ENCODING = 1
+SUBGROUP_ENCODING = 2
+
+# Certainty of the primality tests on the group parameters, as used by vog
+CERTAINTY = 50
+
+
+def integer(i):
+    """
+    Byte tree of a non-negative integer, as encoded by LargeInteger.
+
+    >>> integer(255).hex()
+    '010000000200ff'
+    """
+    return bytetree.leaf(i.to_bytes(i.bit_length() // 8 + 1, 'big'))
+
+
+def marshal(cls, tree):
+    # marshalled objects are a node of the class name and the object
+    return bytetree.node(bytetree.leaf((PKG + cls).encode('ascii')), tree)
+
+
+def descriptor(desc, marshalled):
+    # human readable description and the hex encoded marshalled object, vog
+    # prints it on its own line
+    return "{}::{}\n".format(desc, marshalled.hex())
+
+
+def unmarshal(desc):
+    """
+    Return the class name and the byte tree of a descriptor.
+
+    >>> cls, t = unmarshal(random_device("/dev/urandom"))
+    >>> cls, t.data()
+    ('com.verificatum.crypto.RandomDevice', b'/dev/urandom')
+    """
+    hexstr = desc.strip().split("::")[-1]
+    root = bytetree.ByteTree(bytes.fromhex(hexstr))
+    cls, tree = list(root.children())
+    return cls.data().decode('ascii'), tree
+
+
+def _hashfunction(algorithm):
+    return marshal("crypto.HashfunctionHeuristic",
+                   bytetree.leaf(algorithm.encode('ascii')))
+
+
+def hashfunction(algorithm):
+    return descriptor("HashfunctionHeuristic({})".format(algorithm),
+                      _hashfunction(algorithm))
+
+
+def _prg_heuristic(algorithm):
+    return marshal("crypto.PRGHeuristic", _hashfunction(algorithm))
+
+
+def prg_heuristic(algorithm):
+    return descriptor("PRGHeuristic(HashfunctionHeuristic({}))".format(
+        algorithm), _prg_heuristic(algorithm))
+
+
+def _random_device(path):
+    return marshal("crypto.RandomDevice",
+                   bytetree.leaf(path.encode('ascii')))
+
+
+def random_device(path):
+    return descriptor("RandomDevice({})".format(path), _random_device(path))
+
+
+def prg_combiner(algorithm, path):
+    """
+    Combination of a heuristic PRG and a random device, as used for the
+    Verificatum random source.
+    """
+    return descriptor(
+        "PRGCombiner(PRGHeuristic(HashfunctionHeuristic({})),"
+        "RandomDevice({}))".format(algorithm, path),
+        marshal("crypto.PRGCombiner",
+                bytetree.node(_prg_heuristic(algorithm),
+                              _random_device(path))))
+
+
+def prime_rounds(bits, certainty=CERTAINTY):
+    """
+    Miller-Rabin rounds used by Java's BigInteger.isProbablePrime, which
+    Verificatum relies on, for the given certainty.
+
+    >>> prime_rounds(3071)
+    2
+    """
+    for limit, rounds in [(100, 50), (256, 27), (512, 15), (768, 8),
+                          (1024, 4)]:
+        if bits < limit:
+            break
+    else:
+        rounds = 2
+    return min(rounds, (certainty + 1) // 2)
+
+
+def is_probable_prime(n, rounds=None):
+    """
+    Miller-Rabin primality test.
+
+    >>> [i for i in range(20) if is_probable_prime(i)]
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    """
+    if n < 4:
+        return n in (2, 3)
+    if n % 2 == 0:
+        return False
+    if rounds is None:
+        rounds = prime_rounds(n.bit_length())
+    if gmpy2 is not None:
+        return bool(gmpy2.is_prime(n, rounds))
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    rng = random.SystemRandom()
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def check_modpgroup(p, g):
+    """
+    Check that p is a safe prime and g generates the subgroup of quadratic
+    residues, as vog does for an explicit ModPGroup.
+
+    >>> check_modpgroup(23, 4)
+    >>> check_modpgroup(23, 5)
+    Traceback (most recent call last):
+    ...
+    ValueError: generator is not a quadratic residue of order q
+    """
+    q = (p - 1) // 2
+    # for a prime q > sqrt(p), p = 2q + 1 is prime iff 2^(p-1) = 1 mod p and
+    # p does not divide 2^2 - 1 (Pocklington)
+    safe = p in (5, 7) or (p > 7 and is_probable_prime(q) and
+                           pow(2, p - 1, p) == 1)
+    if not safe:
+        raise ValueError("modulus is not a safe prime")
+    if not (1 < g < p and pow(g, q, p) == 1):
+        raise ValueError("generator is not a quadratic residue of order q")
+
+
+def modpgroup(p, g):
+    """
+    Descriptor of the subgroup of quadratic residues modulo safe prime p
+    generated by g, as `vog -gen ModPGroup -explic p g` prints it. Raises
+    ValueError if the parameters do not define such a group.
+    """
+    check_modpgroup(p, g)
+    q = (p - 1) // 2
+    # group elements are encoded with the byte length of the modulus
+    elemlen = p.bit_length() // 8 + 1
+    tree = bytetree.node(integer(p), integer(q),
+                         bytetree.leaf(g.to_bytes(elemlen, 'big')),
+                         bytetree.leaf(SAFEPRIME_ENCODING.to_bytes(4, 'big')))
+    return descriptor(
+        "ModPGroup(safe-prime modulus=2*order+1. order bit-length = {})"
+        .format(q.bit_length()), marshal("arithm.ModPGroup", tree))
+
+
+def modpgroup_params(desc):
+    """
+    Return (p, q, g) of a ModPGroup descriptor.
+    """
+    cls, tree = unmarshal(desc)
+    if cls != PKG + "arithm.ModPGroup":
+        raise ValueError("not a ModPGroup: {}".format(cls))
+    p, q, g, _ = [c.to_int() for c in tree.children()]
+    return p, q, g
+
+
+STUB = """\
+<!-- ATTENTION! WE STRONGLY ADVICE AGAINST EDITING THIS FILE!
+
+     This is a protocol information file. It contains all the parameters
+     of a protocol session as agreed by all parties.
+
+     Each party must hold an identical copy of this file. WE RECOMMEND
+     YOU TO NOT EDIT THIS FILE UNLESS YOU KNOW EXACTLY WHAT YOU ARE
+     DOING.
+
+     Many XML features are disabled and throw errors when parsed. -->
+
+<protocol>
+
+   <!-- Version of Verificatum Software for which this info is intended. -->
+   <version>{version}</version>
+
+   <!-- Session identifier of this protocol execution. This must be
+        globally unique and satisfy the regular expression
+        [A-Za-z][A-Za-z0-9]{{1,1023}}. -->
+   <sid>{sid}</sid>
+
+   <!-- Name of this protocol execution. This is a short descriptive name
+        that is NOT necessarily unique, but satisfies the regular
+        expression [A-Za-z][A-Za-z0-9_ \\-]{{1,255}}. -->
+   <name>{name}</name>
+
+   <!-- Description of this protocol execution. This is merely a longer
+        description than the name of the protocol execution. It must
+        satisfy the regular expression |[A-Za-z][A-Za-z0-9:;?!.()\\[\\] ]
+        {{0,4000}}. -->
+   <descr></descr>
+
+   <!-- Number of parties taking part in the protocol execution. This must
+        be a positive integer that is at most 25. -->
+   <nopart>{nopart}</nopart>
+
+   <!-- Statistical distance from uniform of objects sampled in the
+        protocol or in proofs of security. This must be a non-negative
+        integer at most 256. -->
+   <statdist>100</statdist>
+
+   <!-- Name of bulletin board implementation used, i.e., a subclass of
+        com.verificatum.protocol.com.BullBoardBasic. WARNING! This field
+        is not validated syntactically. -->
+   <bullboard>com.verificatum.protocol.com.BullBoardBasicHTTPW</bullboard>
+
+   <!-- Threshold number of parties needed to violate the privacy of the
+        protocol, i.e., this is the number of parties needed to decrypt.
+        This must be positive, but at most equal to the number of parties.
+        -->
+   <thres>{thres}</thres>
+
+   <!-- Group over which the protocol is executed. An instance of a
+        subclass of com.verificatum.arithm.PGroup. -->
+   <pgroup>{pgroup}</pgroup>
+
+   <!-- Width of El Gamal keys. If equal to one the standard El Gamal
+        cryptosystem is used, but if it is greater than one, then the
+        natural generalization over a product group of the given width is
+        used. This corresponds to letting each party holding multiple
+        standard public keys. -->
+   <keywidth>{keywidth}</keywidth>
+
+   <!-- Bit length of challenges in interactive proofs. -->
+   <vbitlen>128</vbitlen>
+
+   <!-- Bit length of challenges in non-interactive random-oracle proofs.
+        -->
+   <vbitlenro>256</vbitlenro>
+
+   <!-- Bit length of each component in random vectors used for batching.
+        -->
+   <ebitlen>128</ebitlen>
+
+   <!-- Bit length of each component in random vectors used for batching
+        in non-interactive random-oracle proofs. -->
+   <ebitlenro>256</ebitlenro>
+
+   <!-- Pseudo random generator used to derive random vectors for
+        batching from jointly generated seeds. This can be "SHA-256",
+        "SHA-384", or "SHA-512", in which case
+        com.verificatum.crypto.PRGHeuristic is instantiated based on this
+        hashfunction, or it can be an instance of
+        com.verificatum.crypto.PRG. WARNING! This field is not validated
+        syntactically. -->
+   <prg>SHA-256</prg>
+
+   <!-- Hashfunction used to implement random oracles. It can be one of
+        the strings "SHA-256", "SHA-384", or "SHA-512", in which case
+        com.verificatum.crypto.HashfunctionHeuristic is instantiated, or
+        an instance of com.verificatum.crypto.Hashfunction. Random oracles
+        with various output lengths are then implemented, using the given
+        hashfunction, in com.verificatum.crypto.RandomOracle.
+        WARNING! Do not change the default unless you know exactly what
+        you are doing. This field is not validated syntactically. -->
+   <rohash>SHA-256</rohash>
+
+   <!-- Determines if the proofs of correctness of an execution are
+        interactive or non-interactive. Legal valus are "interactive" or
+        "noninteractive". -->
+   <corr>noninteractive</corr>
+
+   <!-- Default width of ciphertexts processed by the mix-net. A different
+        width can still be forced for a given session by using the
+        "-width" option. -->
+   <width>{width}</width>
+
+   <!-- Maximal number of ciphertexts for which precomputation is
+        performed. Pre-computation can still be forced for a different
+        number of ciphertexts for a given session using the "-maxciph"
+        option during pre-computation. -->
+   <maxciph>0</maxciph>
+
+</protocol>
+"""
+
+
+def stub(sid, name, keywidth, width, nopart, thres, pgroup):
+    """
+    Protocol stub file contents, as written by `vmni -prot`.
+    """
+    return STUB.format(version=VERSION, sid=sid, name=name, nopart=nopart,
+                       thres=thres, pgroup=pgroup.strip(), keywidth=keywidth,
+                       width=width)
+
+
+def merge(protinfos):
+    """
+    Protocol info file merged from the party protocol info files, as written
+    by `vmni -merge`. Only a single party is supported: its protocol info
+    file then already holds the joint parameters and is written as is.
+    Merging several parties checks and combines their party sections, which
+    is left to vmni.
+    """
+    if len(protinfos) != 1:
+        raise ValueError("can not merge {} parties".format(len(protinfos)))
+    root = ET.fromstring(protinfos[0])
+    if root.findtext("nopart") != "1" or len(root.findall("party")) != 1:
+        raise ValueError("protocol info is not of a single party protocol")
+    return protinfos[0]
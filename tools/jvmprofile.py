@@ -0,0 +1,179 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import logging
+import re
+import shutil
+import subprocess
+
+# Stages which can be profiled. The setup stage is left out, as the output
+# of vog is used as is and must not contain recorder messages.
+STAGES = ["convert", "shuffle", "decode", "verify"]
+
+# Where time goes, by the first category with a matching frame anywhere in
+# the stack. The specific libraries come first, so that their use of the JDK
+# is not counted under the generic I/O and arithmetic classes.
+CATEGORIES = [
+    ("json", ["com.fasterxml.jackson.", "ee.ivxv.common.util.Json"]),
+    ("bytetree-io", ["com.verificatum.eio."]),
+    ("arithmetic", ["com.verificatum.arithm.", "com.verificatum.vmgj."]),
+    ("bytetree-io", ["java.io.", "java.nio.", "sun.nio."]),
+    ("arithmetic", ["java.math."]),
+    ("adapter", ["ee.ivxv."]),
+]
+TOP = 15
+# Frames printed per stack trace. The jfr default of 5 cuts off the library
+# frames the categories are matched on.
+STACK_DEPTH = 64
+
+GC_PAUSE = re.compile(r"Pause.* (\d+(?:\.\d+)?)ms$")
+JAVA_VERSION = re.compile(r'version "(\d+)(?:\.(\d+))?')
+# Flight Recorder in OpenJDK and the unified -Xlog option
+MIN_JAVA = 11
+
+log = logging.getLogger("runner")
+
+
+def java_version(text):
+    """
+    Return the major version in the output of java -version.
+
+    >>> java_version('openjdk version "1.8.0_292"')
+    8
+    >>> java_version('java version "11.0.2" 2019-01-15 LTS')
+    11
+    >>> java_version('openjdk version "17" 2021-09-14')
+    17
+    """
+    m = JAVA_VERSION.search(text)
+    if m is None:
+        return None
+    major = int(m.group(1))
+    if major == 1 and m.group(2) is not None:
+        return int(m.group(2))
+    return major
+
+
+def jvm_options(prefix):
+    """
+    JVM options recording a flight recording and GC log with file names
+    starting with prefix.
+    """
+    return ["-XX:StartFlightRecording=settings=profile,dumponexit=true,"
+            "filename={}.jfr".format(prefix),
+            "-Xlog:gc*:file={}-gc.log".format(prefix)]
+
+
+def gc_pauses(path):
+    """
+    Return the number and total milliseconds of GC pauses in a GC log.
+    """
+    count = 0
+    total = 0.0
+    with open(path) as f:
+        for line in f:
+            m = GC_PAUSE.search(line.rstrip())
+            if m:
+                count += 1
+                total += float(m.group(1))
+    return count, total
+
+
+def frame_name(line):
+    # "java.math.BigInteger.oddModPow(BigInteger, BigInteger) line: 2901"
+    return line.strip().split("(", 1)[0]
+
+
+def category(frames):
+    for cat, prefixes in CATEGORIES:
+        for name in frames:
+            if any(name.startswith(p) for p in prefixes):
+                return cat
+    return "other"
+
+
+def stack_traces(lines):
+    """
+    Yield the stack traces, as lists of method names from the top of the
+    stack, in the text output of jfr print.
+    """
+    frames = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("stackTrace = ["):
+            frames = []
+        elif frames is None:
+            continue
+        elif line == "]":
+            yield frames
+            frames = None
+        elif line != "...":
+            frames.append(frame_name(line))
+
+
+def execution_samples(path):
+    """
+    Return the number of execution samples of a flight recording and their
+    counts per category and per top frame, using the jfr tool of the JDK.
+    The output of jfr is aggregated as it is read.
+    """
+    jfr = shutil.which("jfr")
+    if jfr is None:
+        raise OSError("jfr tool not found")
+    count = 0
+    cats = collections.Counter()
+    hot = collections.Counter()
+    with subprocess.Popen([jfr, "print", "--stack-depth", str(STACK_DEPTH),
+                           "--events", "jdk.ExecutionSample", path],
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True) as proc:
+        for frames in stack_traces(proc.stdout):
+            count += 1
+            cats[category(frames)] += 1
+            if frames:
+                hot[frames[0]] += 1
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return count, cats, hot
+
+
+def summarize(prefix, title, elapsed):
+    """
+    Return a short text summary of the recording and GC log at prefix.
+    """
+    lines = ["{} ({:.1f} s)".format(title, elapsed)]
+    try:
+        count, total = gc_pauses(prefix + "-gc.log")
+        lines.append("  GC pauses: {} totalling {:.1f} s ({:.1f}%)".format(
+            count, total / 1000, 100 * total / 1000 / max(elapsed, 1e-9)))
+    except OSError as e:
+        lines.append("  GC log unavailable: {}".format(e))
+    try:
+        count, cats, hot = execution_samples(prefix + ".jfr")
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("Could not read flight recording %s.jfr: %s", prefix, e)
+        lines.append("  flight recording unavailable: {}".format(e))
+        return "\n".join(lines) + "\n"
+    n = max(count, 1)
+    lines.append("  samples: {}".format(count))
+    for cat, c in cats.most_common():
+        lines.append("  {:<12} {:5.1f}%".format(cat, 100.0 * c / n))
+    lines.append("  hot methods:")
+    for name, c in hot.most_common(TOP):
+        lines.append("    {:5.1f}% {}".format(100.0 * c / n, name))
+    return "\n".join(lines) + "\n"
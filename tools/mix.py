@@ -20,8 +20,16 @@
 import argparse
 import asn1
 import base64
+import bytetree
+import convcache
+import infogen
+import json
+import jvmprofile
 import logging
 import os
+import planner
+import posverify
+import resource
 import subprocess
 import sys
 import tempfile
@@ -35,6 +43,9 @@ CP = VERCP + IVXVCP
 WIDTH = 1
 KEYWIDTH = 5
 ENTROPY_THRES = 40
+HEAP_MB = 3000
+# JVM memory outside the heap: metaspace, thread stacks, native buffers
+NONHEAP_MB = 512
 
 log = logging.getLogger("runner")
 logging.basicConfig(level=logging.INFO,
@@ -49,6 +60,14 @@ def random_seed():
     return os.path.expanduser("~/.verificatum_random_seed")
 
 
+def metrics_dir():
+    return os.path.expanduser("~/.verificatum_metrics")
+
+
+def runs_file():
+    return os.path.join(metrics_dir(), "runs.jsonl")
+
+
 def pid():
     return "{}".format(os.getpid())
 
@@ -85,7 +104,7 @@ def vmnv(args):
     return [
         "java",
         "-server",
-        "-Xmx3000m",
+        "-Xmx{}m".format(HEAP_MB),
         "-Djava.security.egd=file:/dev/./urandom",
         "com.verificatum.protocol.mixnet.MixNetElGamalVerifyFiatShamirTool",
         "vmnv",
@@ -109,7 +128,7 @@ def vmni(args):
 def vmnc(args):
     return [
         "java",
-        "-Xmx3000m",
+        "-Xmx{}m".format(HEAP_MB),
         "-Djava.security.egd=file:/dev/./urandom",
         "com.verificatum.protocol.elgamal.ProtocolElGamalInterfaceTool",
         "vmnc",
@@ -122,7 +141,7 @@ def vmnc(args):
 def vmn(args):
     return [
         "java",
-        "-Xmx3000m",
+        "-Xmx{}m".format(HEAP_MB),
         "-Djava.security.egd=file:/dev/./urandom",
         "com.verificatum.protocol.mixnet.MixNetElGamalTool",
         pid(),
@@ -187,13 +206,75 @@ def write_seed(election):
     return f
 
 
-def generate_randomsource():
-    hashfn = run(vog("-gen HashfunctionHeuristic SHA-256".split()))
-    prg = run(vog(["-gen", "PRGHeuristic", hashfn]))
-    urandom = run(vog("-gen RandomDevice /dev/urandom".split()))
+def check_compat(what, native, expected):
+    if native != expected:
+        pos = next((i for i, (a, b) in enumerate(zip(native, expected))
+                    if a != b), min(len(native), len(expected)))
+        log.error("Native %s differs from Verificatum output at byte %d",
+                  what, pos)
+        sys.exit("Native info generation is not compatible, use "
+                 "--info-generator vmni")
+    log.info("Native %s matches Verificatum output", what)
+
+
+def vog_gen(args, native, infogen_mode):
+    """
+    Return the descriptor printed by vog -gen args, or its natively
+    generated equivalent unless infogen_mode is 'vmni'.
+    """
+    if infogen_mode == "native":
+        return native
+    ret = run(vog(["-gen"] + args))
+    if infogen_mode == "compat":
+        check_compat(args[0] + " descriptor", native, ret)
+    return ret
+
+
+def generate_randomsource(infogen_mode="vmni"):
+    hashfn = vog_gen("HashfunctionHeuristic SHA-256".split(),
+                     infogen.hashfunction("SHA-256"), infogen_mode)
+    prg = vog_gen(["PRGHeuristic", hashfn], infogen.prg_heuristic("SHA-256"),
+                  infogen_mode)
+    urandom = vog_gen("RandomDevice /dev/urandom".split(),
+                      infogen.random_device("/dev/urandom"), infogen_mode)
     return [prg, urandom]
 
 
+def generate_stub(election, pgroup, infogen_mode="vmni"):
+    args = ["-prot", "-sid", "ivxv", "-name", election, "-keywidth",
+            get_keywidth(), "-width", get_width(), "-nopart", "1", "-thres",
+            "1", "-pgroup", pgroup]
+    if infogen_mode == "vmni":
+        run(vmni(args + ["stub.xml"]))
+        return
+    native = infogen.stub("ivxv", election, get_keywidth(), get_width(), 1,
+                          1, pgroup)
+    with open("stub.xml", "w") as f:
+        f.write(native)
+    if infogen_mode == "compat":
+        run(vmni(args + ["stub.compat.xml"]))
+        with open("stub.compat.xml") as f:
+            expected = f.read()
+        os.remove("stub.compat.xml")
+        check_compat("stub.xml", native, expected)
+
+
+def merge_protinfo(infogen_mode="vmni"):
+    if infogen_mode == "vmni":
+        run(vmni("-merge protInfo.xml prot.xml".split()))
+        return
+    with open("protInfo.xml") as f:
+        native = infogen.merge([f.read()])
+    with open("prot.xml", "w") as f:
+        f.write(native)
+    if infogen_mode == "compat":
+        run(vmni("-merge protInfo.xml prot.compat.xml".split()))
+        with open("prot.compat.xml") as f:
+            expected = f.read()
+        os.remove("prot.compat.xml")
+        check_compat("prot.xml", native, expected)
+
+
 def empty_entropy_pool():
     log.debug("emptying entropy pool")
     f = open("/dev/random", "rb", 0)
@@ -219,13 +300,120 @@ def current_entropy_level():
     return int(open("/proc/sys/kernel/random/entropy_avail").read())
 
 
-def run(args):
+stage_times = {}
+profile_stages = set()
+profile_dir = None
+profiled = []
+
+
+def setup_profile(stages):
+    global profile_dir
+    if stages == "all":
+        stages = ",".join(jvmprofile.STAGES)
+    for stage in stages.split(","):
+        if stage not in jvmprofile.STAGES:
+            sys.exit("Can not profile stage {}, choose from {}".format(
+                stage, ", ".join(jvmprofile.STAGES)))
+        profile_stages.add(stage)
+    try:
+        out = subprocess.run(["java", "-version"], env=get_env(),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT).stdout
+    except OSError as e:
+        sys.exit("Can not run java to check its version: {}".format(e))
+    version = jvmprofile.java_version(out.decode('utf-8', 'replace'))
+    if version is None or version < jvmprofile.MIN_JAVA:
+        sys.exit("--profile needs Java {} or later for Flight Recorder and "
+                 "GC logging, found {}".format(jvmprofile.MIN_JAVA,
+                                               version or "unknown"))
+    profile_dir = os.path.join(metrics_dir(), "profile-{}-{}".format(
+        time.strftime("%Y%m%d-%H%M%S"), pid()))
+    os.makedirs(profile_dir)
+    log.info("Profiling %s into %s", ", ".join(sorted(profile_stages)),
+             profile_dir)
+
+
+def write_profile_summary(prefix, elapsed):
+    # a broken recording must not fail the stage it was recorded for
+    try:
+        summary = jvmprofile.summarize(prefix, os.path.basename(prefix),
+                                       elapsed)
+        with open(os.path.join(profile_dir, "summary.txt"), "a") as f:
+            f.write(summary)
+    except Exception as e:
+        log.warning("Could not summarize profile %s: %s", prefix, e)
+
+
+def run(args, stage="setup"):
+    prefix = None
+    if stage in profile_stages:
+        prefix = os.path.join(profile_dir, "{}-{}".format(stage,
+                                                          len(profiled)))
+        profiled.append(prefix)
+        # JVM options go before the main class
+        args = args[:1] + jvmprofile.jvm_options(prefix) + args[1:]
     log.debug("running cmd: %s", " ".join(args))
-    ret = subprocess.check_output(args, env=get_env())
+    start = time.time()
+    try:
+        ret = subprocess.check_output(args, env=get_env())
+    finally:
+        elapsed = time.time() - start
+        stage_times[stage] = stage_times.get(stage, 0) + elapsed
+        if prefix is not None:
+            write_profile_summary(prefix, elapsed)
     log.debug("cmd output: %s", ret)
     return ret.decode('ascii')
 
 
+def count_ciphertexts(path):
+    with bytetree.BytetreeFile(path) as bt:
+        s = bytetree.shape(bt.root)
+    if s is None:
+        raise bytetree.ByteTreeError("{} is not an array".format(path))
+    return s[1]
+
+
+def dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def record_run(command, pubkey, ciphertexts, archive=None, converted=None):
+    """
+    Append the stage timings and resource usage of this run to the metrics
+    file, for calibrating the capacity planner. converted is the number of
+    ballots the convert stage worked on, if not all of them.
+    """
+    _, params = parse_key(pubkey)
+    rec = {"time": int(time.time()),
+           "command": command,
+           "ciphertexts": ciphertexts,
+           "bits": int(params[0], 16).bit_length(),
+           "width": WIDTH,
+           "keywidth": KEYWIDTH,
+           "stages": stage_times,
+           # kilobytes on Linux
+           "maxrss": resource.getrusage(
+               resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+    if command == "shuffle":
+        rec["disk"] = dir_size("dir")
+    if converted is not None:
+        rec["converted"] = converted
+    if profile_dir is not None:
+        rec["profile"] = profile_dir
+    if archive is not None:
+        rec["archive"] = os.path.getsize(archive)
+    try:
+        os.makedirs(metrics_dir(), exist_ok=True)
+        with open(runs_file(), "a") as f:
+            f.write(json.dumps(rec) + "\n")
+    except OSError as e:
+        log.warning("Could not record run metrics: %s", e)
+
+
 def pack_proof(zip, pubkey, ballots, shuffled):
     z = zipfile.ZipFile(zip, "w", allowZip64=True)
     z.write("prot.xml")
@@ -246,15 +434,127 @@ def pack_proof(zip, pubkey, ballots, shuffled):
     z.close()
 
 
+def inspect_bytetree(path):
+    with bytetree.BytetreeFile(path) as bt:
+        s = bytetree.shape(bt.root)
+        size = bt.root.size
+        if size != os.path.getsize(path):
+            raise bytetree.ByteTreeError("trailing data after byte tree")
+        if s is None:
+            log.info("%s: %d bytes, node with %d children", path, size,
+                     bt.root.length)
+        else:
+            log.info("%s: %d bytes, %d elements, arities %s, "
+                     "%s bytes per leaf", path, size, s[1], s[0], s[2])
+    return s
+
+
+def inspect(proofdir):
+    """
+    Check the shapes and cardinalities of the byte trees in proofdir without
+    verifying the proof. Returns True if everything is consistent.
+    """
+    ok = True
+    try:
+        with open(os.path.join(proofdir, "width")) as f:
+            width = int(f.read())
+    except (OSError, ValueError):
+        width = WIDTH
+    arities = planner.ciphertext_arities(width, KEYWIDTH)
+    shapes = {}
+    for p in ["Ciphertexts.bt", "ShuffledCiphertexts.bt",
+              "proofs/Ciphertexts01.bt", "proofs/PermutationCommitment01.bt",
+              "proofs/PoSCommitment01.bt", "proofs/PoSReply01.bt"]:
+        path = os.path.join(proofdir, p)
+        try:
+            shapes[p] = inspect_bytetree(path)
+        except (OSError, bytetree.ByteTreeError) as e:
+            log.error("%s: %s", path, e)
+            ok = False
+    for p in ["Ciphertexts.bt", "ShuffledCiphertexts.bt",
+              "proofs/Ciphertexts01.bt"]:
+        s = shapes.get(p)
+        if s is not None and s[0] != arities:
+            log.error("%s: expected arities %s (width %d, keywidth %d), "
+                      "got %s", p, arities, width, KEYWIDTH, s[0])
+            ok = False
+    counts = dict((p, s[1]) for p, s in shapes.items() if s is not None)
+    # B and B' of the commitment, k_B and k_E of the reply are arrays
+    for p, children in [("proofs/PoSCommitment01.bt", [0, 2]),
+                        ("proofs/PoSReply01.bt", [1, 4])]:
+        if p not in shapes:
+            continue
+        with bytetree.BytetreeFile(os.path.join(proofdir, p)) as bt:
+            for i in children:
+                try:
+                    s = bytetree.shape(bt.root.child(i))
+                except bytetree.ByteTreeError:
+                    s = None
+                if s is None:
+                    log.error("%s: child %d is not an array", p, i)
+                    ok = False
+                else:
+                    counts["{}[{}]".format(p, i)] = s[1]
+    if len(set(counts.values())) > 1:
+        log.error("Cardinality mismatch: %s", ", ".join(
+            "{} {}".format(p, c) for p, c in sorted(counts.items())))
+        ok = False
+    leaflens = set(s[2] for s in shapes.values()
+                   if s is not None and s[0] == arities and s[2] is not None)
+    if len(leaflens) > 1:
+        log.error("Ciphertext element lengths differ: %s", sorted(leaflens))
+        ok = False
+    if ok:
+        log.info("Byte trees in %s are consistent", proofdir)
+    return ok
+
+
+def plan(pubkey, bbox=None, ballots=None):
+    _, params = parse_key(pubkey)
+    bits = int(params[0], 16).bit_length()
+    bbox_size = None
+    if bbox is not None:
+        log.info("Counting ballots in %s", bbox)
+        ballots = planner.count_ballots(bbox)
+        bbox_size = os.path.getsize(bbox)
+    model = planner.calibrate(planner.load_runs(runs_file()))
+    for k in list(planner.STAGES) + ["memory", "disk"]:
+        if k not in model["calibrated"]:
+            log.warning("No recorded runs for %s, using uncalibrated "
+                        "defaults", k)
+    p = planner.plan(model, ballots, bits, WIDTH, KEYWIDTH, bbox_size)
+    mb = float(2**20)
+    log.info("Plan for %d ballots, %d-bit group, width %d, keywidth %d",
+             ballots, bits, WIDTH, KEYWIDTH)
+    for stage in planner.SHUFFLE_STAGES + planner.VERIFY_STAGES:
+        log.info("  %-8s %10.0f s (%d runs)", stage, p["times"][stage],
+                 model["calibrated"].get(stage, 0))
+    log.info("  shuffle total %10.0f s", p["shuffle"])
+    log.info("  verify total  %10.0f s", p["verify"])
+    log.info("  peak RSS      %10.0f MB (JVM heap limit %d MB + %d MB "
+             "non-heap)", p["memory"] / mb, HEAP_MB, NONHEAP_MB)
+    log.info("  scratch dir/  %10.0f MB", p["disk"] / mb)
+    log.info("  proof archive %10.0f MB", p["archive"] / mb)
+    if p["memory"] > (HEAP_MB + NONHEAP_MB) * 2**20:
+        log.warning("Predicted RSS exceeds the JVM heap limit and non-heap "
+                    "margin")
+    return p
+
+
 def parse_args(argv):
     parser = argparse.ArgumentParser(
         description="Runner script for running Verificatum mix-net")
-    parser.add_argument("command", choices=['shuffle', 'verify'],
+    parser.add_argument("command",
+                        choices=['shuffle', 'verify', 'audit', 'inspect',
+                                 'plan'],
                         help="Action to take")
     parser.add_argument("--pubkey",
                         help="Location of the public key in PEM format")
     parser.add_argument("--ballotbox",
                         help="Location of the ballot box to be shuffled")
+    parser.add_argument("--ballots", type=int,
+                        help="Number of ballots to plan for, if the ballot "
+                        "box is not given")
     parser.add_argument("--shuffled",
                         help="Output location of the shuffled ballot box")
     parser.add_argument("--empty-entropy-pool",
@@ -266,11 +566,50 @@ def parse_args(argv):
                         "correctness of shuffle to a zip file. "
                         "Additionally, construct a configuration file "
                         "for IVXV auditor application")
+    parser.add_argument("--conversion-cache",
+                        help="Directory of the persistent cache of converted "
+                        "ciphertexts. Only ballots not found in the cache "
+                        "are converted")
+    parser.add_argument("--info-generator", default="vmni",
+                        choices=["vmni", "native", "compat"],
+                        help="Generate the random source and group "
+                        "descriptors and the protocol stub file with the "
+                        "Verificatum tools (vmni), natively in Python "
+                        "(native) or with both, failing if they differ "
+                        "(compat)")
+    parser.add_argument("--profile", metavar="STAGES",
+                        help="Run the comma separated stages ({}) or all "
+                        "of them with Java Flight Recorder and GC logging, "
+                        "and summarize them in a profile directory next to "
+                        "the run metrics".format(
+                            ", ".join(jvmprofile.STAGES)))
+    parser.add_argument("--workers", type=int,
+                        help="Number of processes for the audit command, "
+                        "defaults to the number of CPUs")
+    parser.add_argument("--proofdir", default="dir/nizkp/default",
+                        help="Location of the Verificatum proof directory "
+                        "to inspect (mixnet/ in an extracted proof)")
     parsed = parser.parse_args(argv)
+    if parsed.profile is not None and \
+            parsed.command not in ('shuffle', 'verify'):
+        parser.error("--profile only applies to shuffle and verify, the "
+                     "other commands start no JVM")
+    if parsed.workers is not None and parsed.workers <= 0:
+        parser.error("--workers must be positive")
     return parsed
 
 
-def mix(pubkey, bbox, out, emptyentropypool=False):
+def convert_ballotbox(bbox, out):
+    run(vmnc("-ciphs -ini ee.ivxv.verificatum.Adapter -outi raw prot.xml {} "
+             "{}".format(bbox, out).split()), "convert")
+
+
+def mix(pubkey, bbox, out, emptyentropypool=False, cachedir=None,
+        infogen_mode="vmni"):
+    """
+    Shuffle the ballot box. Returns the number of ballots converted when the
+    conversion cache is used, None otherwise.
+    """
     log.info("Parsing public key")
     election, params = parse_key(pubkey)
     # remove old .verificatum_random_source and .verificatum_random_seed
@@ -281,8 +620,10 @@ def mix(pubkey, bbox, out, emptyentropypool=False):
     seedfile = write_seed(election)
     # generate Verificatum random source description
     log.info("Generating random source description")
-    prg_desc, urandom_desc = generate_randomsource()
-    combined_desc = run(vog(["-gen", "PRGCombiner", prg_desc, urandom_desc]))
+    prg_desc, urandom_desc = generate_randomsource(infogen_mode)
+    combined_desc = vog_gen(["PRGCombiner", prg_desc, urandom_desc],
+                            infogen.prg_combiner("SHA-256", "/dev/urandom"),
+                            infogen_mode)
     # run rndinit to initialize Verificatum random source
     log.info("Initializing Verificatum random source")
     run(vog(["-rndinit", "-seed", seedfile.name, "PRGCombiner", prg_desc,
@@ -298,29 +639,42 @@ def mix(pubkey, bbox, out, emptyentropypool=False):
     else:
         log.info("Skipping entropy pool emptying and collection from user")
     log.info("Generating ElGamal group parameters for Verificatum")
-    pgroup = run(vog("-gen ModPGroup -explic {} {}".
-                     format(params[0], params[1]).split()))
+    native_pgroup = None
+    if infogen_mode != "vmni":
+        try:
+            native_pgroup = infogen.modpgroup(int(params[0], 16),
+                                              int(params[1], 16))
+        except ValueError as e:
+            sys.exit("Invalid group parameters in public key: {}".format(e))
+    pgroup = vog_gen("ModPGroup -explic {} {}".format(params[0],
+                                                      params[1]).split(),
+                     native_pgroup, infogen_mode)
     log.info("Generating Verificatum protocol stub file")
-    run(vmni(["-prot", "-sid", "ivxv", "-name", election, "-keywidth",
-             get_keywidth(), "-width", get_width(), "-nopart", "1", "-thres",
-             "1", "-pgroup", pgroup, "stub.xml"]))
+    generate_stub(election, pgroup, infogen_mode)
     log.info("Generating Verificatum party protocol file")
     run(vmni(["-party", "-name", "Party", "-rand", combined_desc, "-seed",
               seedfile.name, "stub.xml", "privInfo.xml", "protInfo.xml"]))
     log.info("Merging Verificatum protocol file")
-    run(vmni("-merge protInfo.xml prot.xml".split()))
+    merge_protinfo(infogen_mode)
     log.info("Converting IVXV public key to Verificatum format")
     run(vmnc("-pkey -ini ee.ivxv.verificatum.Adapter -outi raw prot.xml {} publickey".format(pubkey).split()))
     log.info("Setting Verificatum public key")
     run(vmn("-setpk privInfo.xml prot.xml publickey".split()))
     log.info("Converting IVXV ballot box to Verificatum ciphertexts")
-    run(vmnc("-ciphs -ini ee.ivxv.verificatum.Adapter -outi raw prot.xml {} ciphertexts".format(bbox).split()))
+    converted = None
+    if cachedir is None:
+        convert_ballotbox(bbox, "ciphertexts")
+    else:
+        converted = convcache.convert(cachedir, params, WIDTH, KEYWIDTH,
+                                      bbox, "ciphertexts", convert_ballotbox)
     log.info("Shuffling ciphertexts")
-    run(vmn("-e -shuffle privInfo.xml prot.xml ciphertexts shuffled".split()))
+    run(vmn("-e -shuffle privInfo.xml prot.xml ciphertexts shuffled".split()),
+        "shuffle")
     log.info("Converting Verificatum ciphertexts to IVXV ballot box")
-    run(vmnc("-ciphs -ini raw -outi ee.ivxv.verificatum.Adapter prot.xml shuffled {}".format(out).split()))
+    run(vmnc("-ciphs -ini raw -outi ee.ivxv.verificatum.Adapter prot.xml shuffled {}".format(out).split()), "decode")
     log.debug("Closing seed file")
     seedfile.close()
+    return converted
 
 
 def verify(proofzip):
@@ -328,7 +682,26 @@ def verify(proofzip):
     log.info("Verifying correctness of the shuffle")
     with zipfile.ZipFile(proofzip) as myzip:
         myzip.extractall()
-    run(vmnv("-shuffle prot.xml mixnet".split()))
+    log.info("Inspecting proof byte trees")
+    if not inspect("mixnet"):
+        sys.exit("Proof byte trees are inconsistent, not verifying")
+    run(vmnv("-shuffle prot.xml mixnet".split()), "verify")
+    log.info("Shuffle verified!")
+
+
+def audit(proofzip, workers=None):
+    log.info("Verifying correctness of the shuffle with the Python verifier")
+    with zipfile.ZipFile(proofzip) as myzip:
+        myzip.extractall()
+    log.info("Inspecting proof byte trees")
+    if not inspect("mixnet"):
+        sys.exit("Proof byte trees are inconsistent, not verifying")
+    try:
+        ok = posverify.verify("prot.xml", "mixnet", workers)
+    except posverify.VerifyError as e:
+        sys.exit("Can not verify proof: {}".format(e))
+    if not ok:
+        sys.exit("Shuffle proof is invalid!")
     log.info("Shuffle verified!")
 
 
@@ -336,15 +709,34 @@ if __name__ == "__main__":
     args = parse_args(sys.argv[1:])
     log.debug("Parsed arguments: {}".format(args))
     log.debug("Script started")
+    if args.profile is not None:
+        setup_profile(args.profile)
 
     if args.command == 'verify':
         verify(args.proof_zipfile)
+        record_run("verify", "Publickey.pem",
+                   count_ciphertexts("mixnet/Ciphertexts.bt"))
+    elif args.command == 'audit':
+        audit(args.proof_zipfile, args.workers)
+    elif args.command == 'plan':
+        if args.ballotbox is None and args.ballots is None:
+            sys.exit("plan requires --ballotbox or --ballots")
+        if args.pubkey is None:
+            sys.exit("plan requires --pubkey")
+        plan(args.pubkey, args.ballotbox, args.ballots)
+    elif args.command == 'inspect':
+        if not inspect(args.proofdir):
+            sys.exit(1)
     else:
-        mix(args.pubkey, args.ballotbox, args.shuffled,
-            emptyentropypool=args.empty_entropy_pool)
+        converted = mix(args.pubkey, args.ballotbox, args.shuffled,
+                        emptyentropypool=args.empty_entropy_pool,
+                        cachedir=args.conversion_cache,
+                        infogen_mode=args.info_generator)
         log.info("Mixing finished.  Shuffled ballot box is located at {}".
                  format(args.shuffled))
         if args.proof_zipfile is not None:
             pack_proof(args.proof_zipfile, args.pubkey, args.ballotbox,
                        args.shuffled)
             log.info("Stored proof in {}".format(args.proof_zipfile))
+        record_run("shuffle", args.pubkey, count_ciphertexts("ciphertexts"),
+                   args.proof_zipfile, converted)
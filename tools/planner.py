@@ -0,0 +1,222 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import bytetree
+
+# Exponent of the group bit length in the per-ciphertext cost of a stage.
+# Conversions are dominated by parsing and copying group elements, shuffling
+# and verifying by modular exponentiations. Setup does not depend on the
+# ballot box and only has a fixed cost.
+STAGES = {"setup": None, "convert": 1, "shuffle": 3, "decode": 1,
+          "verify": 3}
+SHUFFLE_STAGES = ["setup", "convert", "shuffle", "decode"]
+VERIFY_STAGES = ["verify"]
+
+# Uncalibrated (intercept seconds, seconds per work unit) used until runs
+# are recorded. A work unit is a single 2048-bit key component of a
+# ciphertext.
+DEFAULT_COST = {"setup": (15.0, 0.0),
+                "convert": (5.0, 0.0002),
+                "shuffle": (10.0, 0.004),
+                "decode": (5.0, 0.0003),
+                "verify": (10.0, 0.004)}
+# Uncalibrated (intercept bytes, bytes of memory per byte of ciphertexts)
+DEFAULT_MEMORY = (300 * 2**20, 6.0)
+# Uncalibrated ratio of scratch directory size to the proof byte trees
+DEFAULT_DISK = 1.5
+# Size of a ballot in the IVXV JSON ballot box, relative to the bytes of
+# its two group elements (base64 and DER overhead)
+JSON_RATIO = 1.5
+
+
+def load_runs(path):
+    runs = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    # interrupted write
+                    pass
+    except OSError:
+        # nothing recorded yet
+        pass
+    return runs
+
+
+def count_ballots(path):
+    with open(path) as f:
+        abb = json.load(f)
+    return sum(len(cts) for stations in abb["districts"].values()
+               for questions in stations.values()
+               for cts in questions.values())
+
+
+def element_len(bits):
+    # two's complement encoding of a group element, including the sign bit
+    return bits // 8 + 1
+
+
+def field_len(bits):
+    # exponents are encoded with the length of the group order q = (p - 1) / 2
+    return (bits - 1) // 8 + 1
+
+
+def array_size(count, leaflen, arities=()):
+    """
+    Size of a byte tree of count elements of a product group with the given
+    arities, each factor encoded as a leaf of leaflen bytes.
+
+    >>> array_size(2, 1)
+    17
+    >>> array_size(2, 1, (2,))
+    39
+    """
+    size = bytetree.HEADER + count * (bytetree.HEADER + leaflen)
+    for a in reversed(arities):
+        size = bytetree.HEADER + a * size
+    return size
+
+
+def ciphertext_arities(width, keywidth):
+    arities = (2,)
+    if width > 1:
+        arities += (width,)
+    if keywidth > 1:
+        arities += (keywidth,)
+    return arities
+
+
+def proof_size(count, bits, width, keywidth):
+    """
+    Size of the byte trees in the Verificatum proof directory.
+    """
+    leaflen = element_len(bits)
+    exponent = bytetree.HEADER + field_len(bits)
+    arities = ciphertext_arities(width, keywidth)
+    cts = array_size(count, leaflen, arities)
+    elem = bytetree.HEADER + leaflen
+    ct = array_size(1, leaflen, arities)
+    # B and B' arrays, A', C', D' elements and F' ciphertext
+    poscommit = (bytetree.HEADER + 2 * array_size(count, leaflen) +
+                 3 * elem + ct)
+    # k_A, k_C, k_D exponents, k_B and k_E arrays, k_F randomizer
+    posreply = (bytetree.HEADER + 2 * array_size(count, field_len(bits)) +
+                3 * exponent + array_size(keywidth * width, field_len(bits)))
+    return (3 * cts + array_size(count, leaflen) + poscommit + posreply)
+
+
+def work(stage, count, bits, width, keywidth):
+    if STAGES[stage] is None:
+        return 0
+    return count * width * keywidth * (bits / 2048.0) ** STAGES[stage]
+
+
+def fit(points):
+    """
+    Least squares fit of y = a + b * x with non-negative coefficients.
+
+    >>> fit([(1, 3), (2, 5), (3, 7)])
+    (1.0, 2.0)
+    """
+    n = len(points)
+    if n == 0:
+        return None
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx > 0:
+        b = sum((x - mx) * (y - my) for x, y in points) / sxx
+        a = my - b * mx
+        if a >= 0 and b >= 0:
+            return (a, b)
+    if sum(xs) > 0:
+        # too few distinct sizes for an intercept, assume proportionality
+        return (0.0, sum(ys) / sum(xs))
+    return (my, 0.0)
+
+
+def stage_count(run, stage):
+    # with the conversion cache only the new ballots are converted
+    if stage == "convert":
+        return run.get("converted", run["ciphertexts"])
+    return run["ciphertexts"]
+
+
+def calibrate(runs):
+    """
+    Fit the cost model on recorded runs. Returns a dictionary with the time
+    coefficients of every stage, the memory coefficients and the disk ratio,
+    and the number of runs used for each.
+    """
+    model = {"time": dict(DEFAULT_COST), "memory": DEFAULT_MEMORY,
+             "disk": DEFAULT_DISK, "calibrated": {}}
+    # the flight recorder slows down and grows the profiled stages
+    runs = [r for r in runs if "profile" not in r]
+    for stage in STAGES:
+        points = [(work(stage, stage_count(r, stage), r["bits"], r["width"],
+                        r["keywidth"]), r["stages"][stage])
+                  for r in runs if stage in r.get("stages", {})]
+        c = fit(points)
+        if c is not None:
+            model["time"][stage] = c
+            model["calibrated"][stage] = len(points)
+    points = [(r["ciphertexts"] * 2 * r["width"] * r["keywidth"] *
+               element_len(r["bits"]), r["maxrss"])
+              for r in runs if r.get("maxrss")]
+    c = fit(points)
+    if c is not None:
+        model["memory"] = c
+        model["calibrated"]["memory"] = len(points)
+    ratios = [r["disk"] / float(proof_size(r["ciphertexts"], r["bits"],
+                                           r["width"], r["keywidth"]))
+              for r in runs if r.get("disk") and r["command"] == "shuffle"]
+    if ratios:
+        model["disk"] = max(ratios)
+        model["calibrated"]["disk"] = len(ratios)
+    return model
+
+
+def plan(model, count, bits, width, keywidth, ballotbox_size=None):
+    """
+    Predict resource usage of shuffling and verifying count ballots.
+
+    Returns a dictionary with the predicted seconds per stage, the peak
+    resident memory of a JVM stage, the scratch directory size and the proof
+    archive size in bytes.
+    """
+    times = {}
+    for stage in SHUFFLE_STAGES + VERIFY_STAGES:
+        a, b = model["time"][stage]
+        times[stage] = a + b * work(stage, count, bits, width, keywidth)
+    a, b = model["memory"]
+    memory = a + b * count * 2 * width * keywidth * element_len(bits)
+    proof = proof_size(count, bits, width, keywidth)
+    if ballotbox_size is None:
+        ballotbox_size = int(count * 2 * element_len(bits) * JSON_RATIO)
+    return {"times": times,
+            "shuffle": sum(times[s] for s in SHUFFLE_STAGES),
+            "verify": sum(times[s] for s in VERIFY_STAGES),
+            "memory": int(memory),
+            "disk": int(model["disk"] * proof),
+            # the zip file is not compressed
+            "archive": proof + 2 * ballotbox_size}
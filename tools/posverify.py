@@ -0,0 +1,487 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import bytetree
+import infogen
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+HASHES = {"SHA-256": "sha256", "SHA-384": "sha384", "SHA-512": "sha512"}
+READ_CHUNK = 16 * 2**20
+# index ranges per worker, to even out the load
+SPLIT = 4
+# longest index range of a task, bounding the memory of a worker
+MAX_RANGE = 4096
+
+log = logging.getLogger("runner")
+
+
+class VerifyError(Exception):
+    pass
+
+
+def powmod(b, e, m):
+    if gmpy2 is not None:
+        return int(gmpy2.powmod(b, e, m))
+    return pow(b, e, m)
+
+
+def jacobi(a, n):
+    """
+    Jacobi symbol of a modulo odd n.
+
+    >>> [jacobi(a, 7) for a in range(7)]
+    [0, 1, 1, -1, 1, -1, -1]
+    """
+    if gmpy2 is not None:
+        return int(gmpy2.jacobi(a, n))
+    a %= n
+    result = 1
+    while a:
+        zeros = (a & -a).bit_length() - 1
+        a >>= zeros
+        if zeros & 1 and n & 7 in (3, 5):
+            result = -result
+        a, n = n, a
+        if a & 3 == 3 and n & 3 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def in_group(x, p):
+    # quadratic residues modulo safe prime p
+    return 0 < x < p and jacobi(x, p) == 1
+
+
+def int32(i):
+    return bytetree.leaf(i.to_bytes(4, 'big'))
+
+
+def prg(hname, seed, start, length):
+    """
+    Bytes [start, start + length) of the output of the hash function based
+    PRG: H(seed | 0) | H(seed | 1) | ..., with 4 byte big-endian counters.
+    """
+    hlen = hashlib.new(hname).digest_size
+    first = start // hlen
+    last = (start + length - 1) // hlen
+    data = b"".join(hashlib.new(hname, seed + i.to_bytes(4, 'big')).digest()
+                    for i in range(first, last + 1))
+    off = start - first * hlen
+    return data[off:off+length]
+
+
+def derive_ints(hname, seed, nbits, start, count):
+    """
+    Integers start, ..., start + count - 1 of nbits bits each, derived from
+    the PRG output.
+    """
+    size = (nbits + 7) // 8
+    mask = (1 << nbits) - 1
+    data = prg(hname, seed, start * size, count * size)
+    return [int.from_bytes(data[i*size:(i+1)*size], 'big') & mask
+            for i in range(count)]
+
+
+def random_oracle(hname, nbits, chunks):
+    """
+    Random oracle with nbits output on the concatenation of chunks.
+    """
+    h = hashlib.new(hname)
+    h.update(nbits.to_bytes(4, 'big'))
+    for c in chunks:
+        h.update(c)
+    size = (nbits + 7) // 8
+    out = bytearray(prg(hname, h.digest(), 0, size))
+    out[0] &= 0xff >> (8 * size - nbits)
+    return bytes(out)
+
+
+def file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+def same_contents(path1, path2):
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    return all(a == b for a, b in zip(file_chunks(path1), file_chunks(path2)))
+
+
+def leaves(tree):
+    # product group and ring elements, flattened depth-first
+    if tree.is_leaf:
+        return [tree.to_int()]
+    return [x for c in tree.children() for x in leaves(c)]
+
+
+def column(tree, count, elemlen=None):
+    leaflen = tree.leaf_array()
+    if tree.length != count or (count and leaflen is None):
+        raise VerifyError("expected an array of {} elements".format(count))
+    if elemlen is not None and leaflen != elemlen:
+        raise VerifyError("expected group elements of {} bytes, found {}"
+                          .format(elemlen, leaflen))
+    return (tree.start, leaflen)
+
+
+def read_column(mm, col, a, b):
+    start, leaflen = col
+    stride = bytetree.HEADER + leaflen
+    return [int.from_bytes(mm[start + i * stride + bytetree.HEADER:
+                              start + (i + 1) * stride], 'big')
+            for i in range(a, b)]
+
+
+class Mapped(object):
+    def __init__(self, paths):
+        self.files = [open(p, "rb") for p in paths]
+        self.mms = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    for f in self.files]
+
+    def __enter__(self):
+        return self.mms
+
+    def __exit__(self, *exc):
+        for m in self.mms:
+            m.close()
+        for f in self.files:
+            f.close()
+
+
+def _generators(ctx, a, b):
+    # h_i = t_i^((p - 1) / q) mod p, written to the generators byte tree
+    p, q = ctx["p"], ctx["q"]
+    ts = derive_ints(ctx["hash"], ctx["hseed"], p.bit_length() +
+                     ctx["statdist"], a, b - a)
+    elemlen = ctx["elemlen"]
+    data = b"".join(bytetree.leaf(powmod(t, (p - 1) // q, p).to_bytes(
+        elemlen, 'big')) for t in ts)
+    fd = os.open(ctx["hpath"], os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, bytetree.HEADER +
+                  a * (bytetree.HEADER + elemlen))
+    finally:
+        os.close(fd)
+
+
+def _batch(ctx, a, b):
+    """
+    Partial products of indices [a, b) and the checks of B_i.
+    """
+    p, q, g, v = ctx["p"], ctx["q"], ctx["g"], ctx["v"]
+    e = derive_ints(ctx["hash"], ctx["seed"], ctx["ebitlen"], a, b - a)
+    with Mapped([ctx["hpath"], ctx["upath"], ctx["wpath"], ctx["wppath"],
+                 ctx["compath"], ctx["replypath"]]) as mms:
+        hm, um, wm, wpm, cm, rm = mms
+        h = read_column(hm, ctx["hcol"], a, b)
+        u = read_column(um, ctx["ucol"], a, b)
+        ws = [read_column(wm, c, a, b) for c in ctx["wcols"]]
+        wps = [read_column(wpm, c, a, b) for c in ctx["wpcols"]]
+        B = read_column(cm, ctx["Bcol"], max(a - 1, 0), b)
+        Bp = read_column(cm, ctx["Bpcol"], a, b)
+        kB = read_column(rm, ctx["kBcol"], a, b)
+        kE = read_column(rm, ctx["kEcol"], a, b)
+    for x in u + B + Bp + [x for c in ws + wps for x in c]:
+        if not in_group(x, p):
+            return {"error": "element not in group"}
+    if any(k >= q for k in kB + kE):
+        return {"error": "exponent not in field"}
+    prev = B[0] if a > 0 else ctx["h0"]
+    if a > 0:
+        B = B[1:]
+    for i in range(b - a):
+        left = powmod(B[i], v, p) * Bp[i] % p
+        right = powmod(g, kB[i], p) * powmod(prev, kE[i], p) % p
+        if left != right:
+            return {"error": "B_{} check failed".format(a + i)}
+        prev = B[i]
+    res = {"A": 1, "U": 1, "H": 1, "HkE": 1, "E": 1,
+           "F": [1] * len(ws), "Fp": [1] * len(wps)}
+    for i in range(b - a):
+        res["A"] = res["A"] * powmod(u[i], e[i], p) % p
+        res["U"] = res["U"] * u[i] % p
+        res["H"] = res["H"] * h[i] % p
+        res["HkE"] = res["HkE"] * powmod(h[i], kE[i], p) % p
+        res["E"] = res["E"] * e[i] % q
+        for c in range(len(ws)):
+            res["F"][c] = res["F"][c] * powmod(ws[c][i], e[i], p) % p
+            res["Fp"][c] = res["Fp"][c] * powmod(wps[c][i], kE[i], p) % p
+    return res
+
+
+def _ranges(count, parts):
+    step = min(max(1, -(-count // parts)), MAX_RANGE)
+    return [(a, min(a + step, count)) for a in range(0, count, step)]
+
+
+def _run(pool, fn, ctx, count, workers):
+    futures = [pool.submit(fn, ctx, a, b)
+               for a, b in _ranges(count, workers * SPLIT)]
+    return [f.result() for f in futures]
+
+
+def parse_protinfo(path):
+    try:
+        root = ET.parse(path).getroot()
+        info = dict((c.tag, (c.text or "").strip()) for c in root)
+        for k in ["statdist", "vbitlenro", "ebitlenro", "keywidth", "thres",
+                  "nopart"]:
+            info[k] = int(info[k])
+        missing = [k for k in ["version", "sid", "pgroup", "prg", "rohash"]
+                   if k not in info]
+        if missing:
+            raise KeyError(", ".join(missing))
+    except (OSError, ET.ParseError, KeyError, ValueError) as e:
+        raise VerifyError("malformed protocol info {}: {}".format(path, e))
+    for k in ["prg", "rohash"]:
+        if info[k] not in HASHES:
+            raise VerifyError("unsupported {} {}".format(k, info[k]))
+    return info
+
+
+def prefix(info, auxsid):
+    """
+    Prefix to random oracle queries, derived from the protocol info.
+    """
+    hname = HASHES[info["rohash"]]
+    tree = bytetree.node(
+        bytetree.leaf(info["version"].encode('ascii')),
+        bytetree.leaf("{}.{}".format(info["sid"], auxsid).encode('ascii')),
+        int32(info["statdist"]), int32(info["vbitlenro"]),
+        int32(info["ebitlenro"]),
+        bytetree.leaf(info["prg"].encode('ascii')),
+        bytetree.leaf(info["pgroup"].encode('ascii')),
+        bytetree.leaf(info["rohash"].encode('ascii')))
+    return hashlib.new(hname, tree).digest()
+
+
+def read_text(proofdir, name):
+    with open(os.path.join(proofdir, name)) as f:
+        return f.read().strip()
+
+
+def verify(protinfo, proofdir, workers=None):
+    """
+    Verify the non-interactive proofs of shuffle in proofdir against the
+    protocol info file. Returns True if all proofs are valid.
+    """
+    workers = workers or os.cpu_count() or 1
+    info = parse_protinfo(protinfo)
+    hname = HASHES[info["rohash"]]
+    if HASHES[info["prg"]] != hname:
+        raise VerifyError("different PRG and random oracle hash functions "
+                          "are not supported")
+    inputs = [os.path.join(proofdir, "Ciphertexts.bt")]
+    try:
+        if read_text(proofdir, "type") != "shuffling":
+            raise VerifyError("only shuffling proofs are supported")
+        if read_text(proofdir, "version") != info["version"]:
+            raise VerifyError("proof version does not match protocol info")
+        p, q, g = infogen.modpgroup_params(info["pgroup"])
+        rho = prefix(info, read_text(proofdir, "auxsid"))
+        parties = int(read_text(proofdir, "proofs/activethreshold"))
+        if not info["thres"] <= parties <= info["nopart"]:
+            raise VerifyError("active threshold {} is not between the "
+                              "threshold {} and the number of parties {}"
+                              .format(parties, info["thres"],
+                                      info["nopart"]))
+        with bytetree.BytetreeFile(inputs[0]) as bt:
+            s = bytetree.shape(bt.root)
+    except (OSError, ValueError, bytetree.ByteTreeError) as e:
+        raise VerifyError("malformed proof directory {}: {}".format(
+            proofdir, e))
+    seedlen = 8 * hashlib.new(hname).digest_size
+    ctx = {"p": p, "q": q, "g": g, "hash": hname,
+           "statdist": info["statdist"], "vbitlen": info["vbitlenro"],
+           "ebitlen": info["ebitlenro"], "keywidth": info["keywidth"]}
+    inputs += [os.path.join(proofdir, "proofs", "Ciphertexts{:02d}.bt".format(
+        j)) for j in range(1, parties + 1)]
+    if s is None or s[1] == 0:
+        raise VerifyError("no ciphertexts to verify")
+    count = s[1]
+    # group elements are encoded with the byte length of the modulus
+    ctx["elemlen"] = p.bit_length() // 8 + 1
+    if s[2] != ctx["elemlen"]:
+        raise VerifyError("expected group elements of {} bytes, found {}"
+                          .format(ctx["elemlen"], s[2]))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            log.info("Deriving %d independent generators with %d workers",
+                     count, workers)
+            ctx["hpath"] = os.path.join(tmpdir, "generators.bt")
+            with open(ctx["hpath"], "wb") as f:
+                f.write(bytetree.node_header(count))
+                f.truncate(bytetree.HEADER +
+                           count * (bytetree.HEADER + ctx["elemlen"]))
+            ctx["hseed"] = random_oracle(hname, seedlen, [
+                rho, bytetree.leaf(b"generators")])
+            _run(pool, _generators, ctx, count, workers)
+            with bytetree.BytetreeFile(ctx["hpath"]) as bt:
+                ctx["hcol"] = column(bt.root, count)
+                ctx["h0"] = bt.root.child(0).to_int()
+            for j in range(1, parties + 1):
+                log.info("Verifying proof of shuffle of party %d", j)
+                if not verify_party(pool, ctx, workers, rho, seedlen,
+                                    proofdir, j, inputs[j - 1], inputs[j],
+                                    count):
+                    return False
+    finally:
+        shutil.rmtree(tmpdir)
+    shuffled = os.path.join(proofdir, "ShuffledCiphertexts.bt")
+    try:
+        same = same_contents(shuffled, inputs[-1])
+    except OSError as e:
+        raise VerifyError("can not compare the output ciphertexts: {}".format(
+            e))
+    if not same:
+        log.error("Output of the last party differs from %s", shuffled)
+        return False
+    return True
+
+
+def verify_party(pool, ctx, workers, rho, seedlen, proofdir, j, wpath, wppath,
+                 count):
+    p, q, g = ctx["p"], ctx["q"], ctx["g"]
+    hname = ctx["hash"]
+    proofs = os.path.join(proofdir, "proofs")
+    ctx = dict(ctx)
+    ctx.update({
+        "upath": os.path.join(proofs,
+                              "PermutationCommitment{:02d}.bt".format(j)),
+        "wpath": wpath, "wppath": wppath,
+        "compath": os.path.join(proofs, "PoSCommitment{:02d}.bt".format(j)),
+        "replypath": os.path.join(proofs, "PoSReply{:02d}.bt".format(j))})
+    pkpath = os.path.join(proofdir, "FullPublicKey.bt")
+    try:
+        with Mapped([ctx["upath"], ctx["wpath"], ctx["wppath"],
+                     ctx["compath"], ctx["replypath"], pkpath]) as mms:
+            um, wm, wpm, cm, rm, pm = [bytetree.ByteTree(m) for m in mms]
+            elemlen = ctx["elemlen"]
+            ctx["ucol"] = column(um, count, elemlen)
+            ctx["wcols"] = [column(c, count, elemlen)
+                            for c in bytetree.columns(wm)]
+            ctx["wpcols"] = [column(c, count, elemlen)
+                             for c in bytetree.columns(wpm)]
+            if len(ctx["wcols"]) != len(ctx["wpcols"]):
+                raise VerifyError("input and output widths differ")
+            if cm.length != 6 or rm.length != 6:
+                raise VerifyError("malformed proof commitment or reply")
+            Bt, Apt, Bpt, Cpt, Dpt, Fpt = cm.children()
+            ctx["Bcol"] = column(Bt, count, elemlen)
+            ctx["Bpcol"] = column(Bpt, count, elemlen)
+            Ap, Cp, Dp = Apt.to_int(), Cpt.to_int(), Dpt.to_int()
+            Fp = leaves(Fpt)
+            kAt, kBt, kCt, kDt, kEt, kFt = rm.children()
+            ctx["kBcol"] = column(kBt, count)
+            ctx["kEcol"] = column(kEt, count)
+            kA, kC, kD = kAt.to_int(), kCt.to_int(), kDt.to_int()
+            kF = leaves(kFt)
+            pk = leaves(pm)
+            BN = Bt.child(count - 1).to_int()
+    except (OSError, ValueError, bytetree.ByteTreeError) as e:
+        raise VerifyError("malformed proof of party {}: {}".format(j, e))
+    keywidth = ctx["keywidth"]
+    if len(pk) != 2 * keywidth:
+        raise VerifyError("public key width {} does not match keywidth {} "
+                          "of the protocol info".format(len(pk) // 2,
+                                                        keywidth))
+    # group elements in either half of a ciphertext
+    factors = len(ctx["wcols"]) // 2
+    if len(Fp) != 2 * factors or len(kF) != factors or factors % keywidth:
+        raise VerifyError("malformed ciphertext widths")
+    if not all(in_group(x, p) for x in [Ap, Cp, Dp] + Fp + pk) or \
+            not all(k < q for k in [kA, kC, kD] + kF):
+        log.error("Proof of party %d has elements outside the group", j)
+        return False
+
+    # s = RO(rho | node(g, h, u, pk, w, w'))
+    elemlen = ctx["elemlen"]
+    chunks = [rho, bytetree.node_header(6),
+              bytetree.leaf(g.to_bytes(elemlen, 'big'))]
+    ctx["seed"] = random_oracle(hname, seedlen, _chain(
+        chunks, [ctx["hpath"], ctx["upath"], pkpath, wpath, wppath]))
+    # v = RO(rho | node(leaf(s), tau))
+    ctx["v"] = v = int.from_bytes(random_oracle(hname, ctx["vbitlen"], _chain(
+        [rho, bytetree.node_header(2), bytetree.leaf(ctx["seed"])],
+        [ctx["compath"]])), 'big')
+
+    parts = _run(pool, _batch, ctx, count, workers)
+    for part in parts:
+        if "error" in part:
+            log.error("Proof of party %d: %s", j, part["error"])
+            return False
+    A, U, H, HkE, E = 1, 1, 1, 1, 1
+    F = [1] * (2 * factors)
+    Fw = [1] * (2 * factors)
+    for part in parts:
+        A = A * part["A"] % p
+        U = U * part["U"] % p
+        H = H * part["H"] % p
+        HkE = HkE * part["HkE"] % p
+        E = E * part["E"] % q
+        F = [x * y % p for x, y in zip(F, part["F"])]
+        Fw = [x * y % p for x, y in zip(Fw, part["Fp"])]
+    # inverse by Fermat's little theorem, p is prime
+    C = U * powmod(H, p - 2, p) % p
+    D = BN * powmod(ctx["h0"], (-E) % q, p) % p
+
+    checks = [
+        ("A", powmod(A, v, p) * Ap % p,
+         powmod(g, kA, p) * HkE % p),
+        ("C", powmod(C, v, p) * Cp % p, powmod(g, kC, p)),
+        ("D", powmod(D, v, p) * Dp % p, powmod(g, kD, p)),
+    ]
+    # F^v F' = Enc_pk(1, -k_F) prod w'_i^(k_E,i), key factors repeat over
+    # the width
+    for c in range(2 * factors):
+        key = pk[c % factors % keywidth + (keywidth if c >= factors else 0)]
+        enc = powmod(key, (-kF[c % factors]) % q, p)
+        checks.append(("F[{}]".format(c), powmod(F[c], v, p) * Fp[c] % p,
+                       enc * Fw[c] % p))
+    for name, left, right in checks:
+        if left != right:
+            log.error("Proof of party %d: %s check failed", j, name)
+            return False
+    return True
+
+
+def _chain(chunks, paths):
+    for c in chunks:
+        yield c
+    for path in paths:
+        for c in file_chunks(path):
+            yield c
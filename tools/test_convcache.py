@@ -0,0 +1,151 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import json
+import os
+import random
+
+import bytetree
+import convcache
+
+LEAFLEN = 9
+KEYWIDTH = 5
+
+
+def der(tag, content):
+    assert len(content) < 128
+    return bytes([tag, len(content)]) + content
+
+
+def der_integer(i):
+    return der(0x02, i.to_bytes(i.bit_length() // 8 + 1, 'big'))
+
+
+def ballot(u, v):
+    # algorithm identifier followed by the blind and the blinded message
+    algorithm = der(0x30, der(0x06, b"\x2a\x03") + der(0x30, der_integer(7)))
+    return der(0x30, algorithm + der(0x30, der_integer(u) + der_integer(v)))
+
+
+def label_element(label):
+    return int.from_bytes(hashlib.sha256(label.encode()).digest()[:8], 'big')
+
+
+def fake_convert(bbox, out, order=None):
+    # stands in for vmnc: ciphertexts in the order of the ballot box, the
+    # labels in the first factors and the ballot in the last factor
+    with open(bbox) as f:
+        abb = json.load(f)
+    cts = []
+    for labels, ct in convcache.ballots(abb):
+        u, v = convcache.ciphertext_elements(ct)
+        left = [label_element(lb) for lb in labels] + [u]
+        cts.append((left, [1] * (KEYWIDTH - 1) + [v]))
+    if order is not None:
+        cts = order(cts)
+
+    def array(vals):
+        return bytetree.node(*[bytetree.leaf(x.to_bytes(LEAFLEN, 'big'))
+                               for x in vals])
+
+    halves = [bytetree.node(*[array([ct[h][j] for ct in cts])
+                              for j in range(KEYWIDTH)]) for h in (0, 1)]
+    with open(out, "wb") as f:
+        f.write(bytetree.node(*halves))
+
+
+def ballot_box(rng, count, districts=2):
+    abb = {"election": "TEST", "districts": {}}
+    for i in range(count):
+        d = "d{}".format(i % districts)
+        ct = ballot(rng.getrandbits(64), rng.getrandbits(64))
+        abb["districts"].setdefault(d, {}).setdefault("s", {}) \
+            .setdefault("q", []).append(base64.b64encode(ct).decode())
+    return abb
+
+
+def write_box(path, abb):
+    with open(path, "w") as f:
+        json.dump(abb, f)
+    return path
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_grown_box_matches_full_conversion(tmp_path):
+    rng = random.Random(1)
+    cache = str(tmp_path / "cache")
+    abb = ballot_box(rng, 20)
+    bbox = write_box(str(tmp_path / "box1.json"), abb)
+    out = str(tmp_path / "cts1")
+    assert convcache.convert(cache, ("p", "g"), 1, KEYWIDTH, bbox, out,
+                             fake_convert) == 20
+    full = str(tmp_path / "full1")
+    fake_convert(bbox, full)
+    assert read(out) == read(full)
+
+    # the grown box keeps the old ballots, also gaining a new district
+    for d, stations in ballot_box(rng, 7, 3)["districts"].items():
+        abb["districts"].setdefault(d, {"s": {"q": []}})["s"]["q"].extend(
+            stations["s"]["q"])
+    bbox = write_box(str(tmp_path / "box2.json"), abb)
+    out = str(tmp_path / "cts2")
+    assert convcache.convert(cache, ("p", "g"), 1, KEYWIDTH, bbox, out,
+                             fake_convert) == 7
+    full = str(tmp_path / "full2")
+    fake_convert(bbox, full)
+    assert read(out) == read(full)
+
+
+def test_misordered_conversion_is_not_cached(tmp_path):
+    cache = str(tmp_path / "cache")
+    bbox = write_box(str(tmp_path / "box.json"),
+                     ballot_box(random.Random(2), 10))
+
+    def reversed_convert(bbox, out):
+        fake_convert(bbox, out, order=lambda cts: cts[::-1])
+
+    out = str(tmp_path / "cts")
+    assert convcache.convert(cache, ("p", "g"), 1, KEYWIDTH, bbox, out,
+                             reversed_convert) == 10
+    full = str(tmp_path / "full")
+    reversed_convert(bbox, full)
+    assert read(out) == read(full)
+    assert not any(f.endswith(".store") for f in os.listdir(cache))
+
+
+def test_invalid_store_is_replaced(tmp_path):
+    cache = str(tmp_path / "cache")
+    bbox = write_box(str(tmp_path / "box.json"),
+                     ballot_box(random.Random(3), 5))
+    for header in [b"", b'{"leaflen": 9}\n']:
+        os.makedirs(cache, exist_ok=True)
+        path = os.path.join(cache, convcache.fingerprint(
+            ("p", "g"), 1, KEYWIDTH) + ".store")
+        with open(path, "wb") as f:
+            f.write(header)
+        out = str(tmp_path / "cts")
+        assert convcache.convert(cache, ("p", "g"), 1, KEYWIDTH, bbox, out,
+                                 fake_convert) == 5
+        full = str(tmp_path / "full")
+        fake_convert(bbox, full)
+        assert read(out) == read(full)
@@ -0,0 +1,300 @@
+# Copyright (C) 2019 State Electoral Office
+#
+# This file is part of ivxv-verificatum.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import random
+import shutil
+
+import pytest
+
+import bytetree
+import infogen
+import planner
+import posverify
+from bytetree import leaf, node
+
+COUNT = 12
+KEYWIDTH = 5
+BITS = 160
+# proof generated by Verificatum with testdata/make_vmn_proof.sh
+VMN_PROOF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "testdata", "vmn")
+
+
+def safe_prime(rng, bits):
+    while True:
+        q = rng.getrandbits(bits - 1) | (1 << (bits - 2)) | 1
+        if infogen.is_probable_prime(q) and \
+                infogen.is_probable_prime(2 * q + 1):
+            return 2 * q + 1
+
+
+def prove(proofdir, count, rng):
+    """
+    Shuffle count random ciphertexts and write the protocol info file and a
+    proof directory with the proof of shuffle of a single party, following
+    the prover of the Verificatum mix-net.
+    """
+    p = safe_prime(rng, BITS)
+    q = (p - 1) // 2
+    g = 4
+    m = KEYWIDTH
+    elemlen = p.bit_length() // 8 + 1
+    fieldlen = planner.field_len(p.bit_length())
+
+    def elem(x):
+        return leaf(x.to_bytes(elemlen, 'big'))
+
+    def exp(x):
+        return leaf(x.to_bytes(fieldlen, 'big'))
+
+    def rnd():
+        return rng.randrange(q)
+
+    def mul(a, b):
+        return [x * y % p for x, y in zip(a, b)]
+
+    def ciphertexts(cs):
+        return node(*[node(*[node(*[elem(c[h * m + j]) for c in cs])
+                             for j in range(m)]) for h in (0, 1)])
+
+    y = [pow(g, rnd(), p) for _ in range(m)]
+    pk = node(node(*[elem(g)] * m), node(*map(elem, y)))
+
+    def enc(r):
+        return [pow(g, ri, p) for ri in r] + \
+            [pow(yi, ri, p) for yi, ri in zip(y, r)]
+
+    w = [mul(enc([rnd() for _ in range(m)]),
+             [1] * m + [pow(g, rnd(), p) for _ in range(m)])
+         for _ in range(count)]
+    perm = list(range(count))
+    rng.shuffle(perm)
+    inv = [0] * count
+    for i, j in enumerate(perm):
+        inv[j] = i
+    s = [[rnd() for _ in range(m)] for _ in range(count)]
+    wp = [mul(w[inv[i]], enc(s[i])) for i in range(count)]
+
+    protinfo = os.path.join(proofdir, "prot.xml")
+    mixnet = os.path.join(proofdir, "mixnet")
+    os.makedirs(os.path.join(mixnet, "proofs"))
+    with open(protinfo, "w") as f:
+        f.write(infogen.stub("ivxv", "Test", KEYWIDTH, 1, 1, 1,
+                             infogen.modpgroup(p, g)))
+    files = {"type": b"shuffling\n", "version": b"3.0.4\n",
+             "auxsid": b"default\n", "width": b"1\n",
+             "proofs/activethreshold": b"1\n",
+             "FullPublicKey.bt": pk,
+             "Ciphertexts.bt": ciphertexts(w),
+             "proofs/Ciphertexts01.bt": ciphertexts(wp),
+             "ShuffledCiphertexts.bt": ciphertexts(wp)}
+
+    info = posverify.parse_protinfo(protinfo)
+    rho = posverify.prefix(info, "default")
+    hseed = posverify.random_oracle("sha256", 256, [rho, leaf(b"generators")])
+    h = [pow(t, 2, p) for t in posverify.derive_ints(
+        "sha256", hseed, p.bit_length() + info["statdist"], 0, count)]
+    r = [rnd() for _ in range(count)]
+    u = node(*[elem(pow(g, r[i], p) * h[perm[i]] % p) for i in range(count)])
+    files["proofs/PermutationCommitment01.bt"] = u
+    seed = posverify.random_oracle("sha256", 256, [rho, node(
+        elem(g), node(*map(elem, h)), u, pk, ciphertexts(w),
+        ciphertexts(wp))])
+    e = posverify.derive_ints("sha256", seed, 256, 0, count)
+    ep = [e[inv[i]] for i in range(count)]
+
+    b = [rnd() for _ in range(count)]
+    B = []
+    prev, d = h[0], 0
+    for i in range(count):
+        prev = pow(g, b[i], p) * pow(prev, ep[i], p) % p
+        B.append(prev)
+        d = (b[i] + ep[i] * d) % q
+    alpha, gamma, delta = rnd(), rnd(), rnd()
+    beta = [rnd() for _ in range(count)]
+    eps = [rnd() for _ in range(count)]
+    phi = [rnd() for _ in range(m)]
+    Ap = pow(g, alpha, p)
+    for i in range(count):
+        Ap = Ap * pow(h[i], eps[i], p) % p
+    Bprev = [h[0]] + B[:-1]
+    Bp = [pow(g, beta[i], p) * pow(Bprev[i], eps[i], p) % p
+          for i in range(count)]
+    Fp = enc([(-x) % q for x in phi])
+    for i in range(count):
+        Fp = mul(Fp, [pow(c, eps[i], p) for c in wp[i]])
+    tau = node(node(*map(elem, B)), elem(Ap), node(*map(elem, Bp)),
+               elem(pow(g, gamma, p)), elem(pow(g, delta, p)),
+               node(node(*map(elem, Fp[:m])), node(*map(elem, Fp[m:]))))
+    files["proofs/PoSCommitment01.bt"] = tau
+    v = int.from_bytes(posverify.random_oracle(
+        "sha256", 256, [rho, node(leaf(seed), tau)]), 'big')
+
+    a = sum(ri * ei for ri, ei in zip(r, e)) % q
+    f = [sum(s[i][j] * ep[i] for i in range(count)) % q for j in range(m)]
+    files["proofs/PoSReply01.bt"] = node(
+        exp((alpha + v * a) % q),
+        node(*[exp((beta[i] + v * b[i]) % q) for i in range(count)]),
+        exp((gamma + v * sum(r)) % q), exp((delta + v * d) % q),
+        node(*[exp((eps[i] + v * ep[i]) % q) for i in range(count)]),
+        node(*[exp((phi[j] + v * f[j]) % q) for j in range(m)]))
+
+    for name, data in files.items():
+        with open(os.path.join(mixnet, name), "wb") as fd:
+            fd.write(data)
+    return p, q, g
+
+
+@pytest.fixture(scope="module")
+def honest(tmp_path_factory):
+    proofdir = str(tmp_path_factory.mktemp("honest"))
+    group = prove(proofdir, COUNT, random.Random(5))
+    return proofdir, group
+
+
+@pytest.fixture
+def proof(honest, tmp_path):
+    proofdir = str(tmp_path / "proof")
+    shutil.copytree(honest[0], proofdir)
+    return proofdir, honest[1]
+
+
+def verify(proofdir):
+    return posverify.verify(os.path.join(proofdir, "prot.xml"),
+                            os.path.join(proofdir, "mixnet"), workers=2)
+
+
+def change_leaf(path, indices, fn):
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    tree = bytetree.ByteTree(bytes(data))
+    for i in indices:
+        tree = tree.child(i)
+    value = fn(tree.to_int()).to_bytes(tree.length, 'big')
+    data[tree.start:tree.end] = value
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_honest_proof(proof):
+    assert verify(proof[0])
+
+
+@pytest.mark.skipif(not os.path.exists(os.path.join(VMN_PROOF, "prot.xml")),
+                    reason="run testdata/make_vmn_proof.sh with Verificatum")
+def test_vmn_proof(tmp_path):
+    proofdir = str(tmp_path / "proof")
+    shutil.copytree(VMN_PROOF, proofdir)
+    assert verify(proofdir)
+    # a changed output of the single party is rejected
+    info = posverify.parse_protinfo(os.path.join(proofdir, "prot.xml"))
+    p, q, g = infogen.modpgroup_params(info["pgroup"])
+    for name in ["ShuffledCiphertexts.bt", "proofs/Ciphertexts01.bt"]:
+        path = os.path.join(proofdir, "mixnet", name)
+        # the first leaf of the second half, whatever the key width
+        indices = [1]
+        with bytetree.BytetreeFile(path) as bt:
+            tree = bt.root.child(1)
+            while not tree.is_leaf:
+                tree = tree.child(0)
+                indices.append(0)
+        change_leaf(path, indices, lambda x: x * g % p)
+    assert not verify(proofdir)
+
+
+def test_honest_proof_in_short_ranges(proof, monkeypatch):
+    # the B_i chain crosses the ranges of the tasks
+    monkeypatch.setattr(posverify, "MAX_RANGE", 5)
+    assert verify(proof[0])
+
+
+@pytest.mark.parametrize("indices,change", [
+    (["PoSCommitment01.bt", 2, 3], "element"),
+    (["PoSReply01.bt", 4, 0], "exponent"),
+    (["PoSCommitment01.bt", 5, 1, 4], "element"),
+], ids=["B'", "k_E", "F'"])
+def test_tampered_proof(proof, indices, change):
+    proofdir, (p, q, g) = proof
+    path = os.path.join(proofdir, "mixnet", "proofs", indices[0])
+    if change == "element":
+        change_leaf(path, indices[1:], lambda x: x * g % p)
+    else:
+        change_leaf(path, indices[1:], lambda x: (x + 1) % q)
+    assert not verify(proofdir)
+
+
+@pytest.mark.parametrize("names", [
+    ["ShuffledCiphertexts.bt"],
+    ["ShuffledCiphertexts.bt", "proofs/Ciphertexts01.bt"],
+])
+def test_tampered_output(proof, names):
+    proofdir, (p, q, g) = proof
+    for name in names:
+        change_leaf(os.path.join(proofdir, "mixnet", name), [1, 4, 0],
+                    lambda x: x * g % p)
+    assert not verify(proofdir)
+
+
+@pytest.mark.parametrize("name,content", [
+    ("prot.xml", b"<protocol>"),
+    ("mixnet/proofs/activethreshold", b"one\n"),
+    ("mixnet/FullPublicKey.bt", b"\x00\x00"),
+    ("mixnet/Ciphertexts.bt", b"\x07\x00\x00\x00\x00"),
+])
+def test_malformed_proof(proof, name, content):
+    with open(os.path.join(proof[0], name), "wb") as f:
+        f.write(content)
+    with pytest.raises(posverify.VerifyError):
+        verify(proof[0])
+
+
+def test_no_active_parties(proof):
+    # without any proofs of shuffle the output would trivially match
+    mixnet = os.path.join(proof[0], "mixnet")
+    with open(os.path.join(mixnet, "proofs", "activethreshold"), "w") as f:
+        f.write("0\n")
+    shutil.copy(os.path.join(mixnet, "Ciphertexts.bt"),
+                os.path.join(mixnet, "ShuffledCiphertexts.bt"))
+    with pytest.raises(posverify.VerifyError):
+        verify(proof[0])
+
+
+def test_short_ciphertext_leaves(proof):
+    path = os.path.join(proof[0], "mixnet", "Ciphertexts.bt")
+    leaves = node(*[leaf(b"\x00\x02")] * COUNT)
+    with open(path, "wb") as f:
+        f.write(node(*[node(*[leaves] * KEYWIDTH)] * 2))
+    with pytest.raises(posverify.VerifyError):
+        verify(proof[0])
+
+
+def test_missing_file(proof):
+    os.remove(os.path.join(proof[0], "mixnet", "auxsid"))
+    with pytest.raises(posverify.VerifyError):
+        verify(proof[0])
+
+
+def test_keywidth_mismatch(proof):
+    path = os.path.join(proof[0], "prot.xml")
+    with open(path) as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(text.replace("<keywidth>5</keywidth>",
+                             "<keywidth>1</keywidth>"))
+    with pytest.raises(posverify.VerifyError):
+        verify(proof[0])
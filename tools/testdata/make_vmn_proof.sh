@@ -0,0 +1,27 @@
+#!/bin/bash
+#
+# Generate a small proof of shuffle with Verificatum into testdata/vmn, for
+# checking the Python verifier against proofs it did not produce itself.
+# Needs vog, vmni, vmn and vmnd of Verificatum 3.0.4 on the PATH.
+
+set -e
+
+OUT=$(cd "$(dirname "$0")" && pwd)/vmn
+WORK=$(mktemp -d)
+trap 'rm -rf "$WORK"' EXIT
+cd "$WORK"
+
+vog -rndinit RandomDevice /dev/urandom
+PGROUP=$(vog -gen ModPGroup -fixed 1024)
+vmni -prot -sid Test -name Test -nopart 1 -thres 1 -keywidth 1 \
+    -pgroup "$PGROUP" stub.xml
+vmni -party -name Party stub.xml privInfo.xml protInfo.xml
+vmni -merge protInfo.xml prot.xml
+vmn -keygen privInfo.xml prot.xml publickey
+vmnd -ciphs publickey 5 ciphertexts
+vmn -e -shuffle privInfo.xml prot.xml ciphertexts shuffled
+
+rm -rf "$OUT"
+mkdir -p "$OUT"
+cp prot.xml "$OUT"
+cp -r dir/nizkp/default "$OUT/mixnet"